@@ -3,17 +3,105 @@ import json
 import logging
 import os
 import signal
-from collections import defaultdict
 from dataclasses import dataclass
 from enum import Enum
-from itertools import takewhile
-from typing import List, Any
+from typing import List, Any, Tuple
 
 import aiomqtt
+import orjson
+import uvloop
 from aiomqtt import Message
 from miio import DeviceFactory, AirHumidifierMiot
 from miio.integrations.zhimi.humidifier.airhumidifier_miot import OperationMode, LedBrightness
 
+# поля из меты ручки, которые дублируются в отдельные топики /meta/<field>
+META_FIELDS = ('type', 'order', 'readonly', 'min', 'max')
+
+
+def to_payload(value: Any) -> bytes:
+    """
+    Значение для публикации в mqtt в готовом виде, чтобы aiomqtt не кодировал его сам
+    в топик надо отправлять 0 или 1 вместо true/false, None публикуется пустым сообщением
+    """
+    if isinstance(value, bool):
+        return b'1' if value else b'0'
+    if value is None:
+        return b''
+    return str(value).encode()
+
+
+def build_meta_publish_plan(meta_topics: dict, device_name: str) -> List[Tuple[str, bytes]]:
+    """
+    Список (топик, значение) для публикации метаинформации устройства в соответствии с конвенцией wirenboard MQTT
+    meta_topics не меняется за время работы, поэтому все значения считаем один раз
+    """
+    device_topic = f'/devices/{device_name}'
+    plan = []
+    for k, meta_data in meta_topics.items():
+        if k == 'meta':
+            # Публикация высокоуровневой метинформации об устройстве, публикуем английское написание
+            topic = device_topic
+            plan.append((topic + '/meta/name', to_payload(meta_data['title']['en'])))
+            plan.append((topic + '/meta/driver', to_payload(meta_data['driver'])))
+            # раньше сюда публиковалась ошибка всего устройства, которую никто не снимал,
+            # пустое retained сообщение удаляет ее с брокера
+            plan.append((topic + '/meta/error', b''))
+        else:
+            # Публикация метаинформации по конкретным ручкам устройства
+            topic = f'{device_topic}/controls/{k}'
+            for f in META_FIELDS:
+                if f == 'readonly':
+                    # true, false превращаем в 0 или 1 для публикации в топик /meta/readonly
+                    # потому что в json который в /meta там должно быть true/false и это более удобно для чтения
+                    value = int(meta_data.get(f, False))
+                else:
+                    # для остальных значений трансморфмация не требуется
+                    value = meta_data.get(f)
+                if value is not None:
+                    # если флаг есть в json метафайле, то публикуем его в топик
+                    plan.append((topic + f'/meta/{f}', to_payload(value)))
+        # готовый json для топика /meta
+        plan.append((topic + '/meta', orjson.dumps(meta_data)))
+    return plan
+
+
+def seconds_to_hours(value: int) -> bytes:
+    return to_payload(value // 3600)
+
+
+def water_level_to_percent(value: int) -> bytes:
+    return to_payload(value // 1.27)
+
+
+# преобразование значений ручек перед публикацией в mqtt, для остальных ручек используется to_payload
+VALUE_TRANSFORMERS = {
+    'use_time': seconds_to_hours,
+    'power_time': seconds_to_hours,
+    'water_level': water_level_to_percent,
+}
+
+
+def set_power(dev: AirHumidifierMiot, value: bool):
+    return dev.on() if value else dev.off()
+
+
+# Таблица трансляции сигналов из mqtt топиков в команды для устройства
+# для каждой ручки имеем функцию трансформации значения из топика и имя метода, который
+# надо дернуть на устройстве чтобы действие применилось, метод ищется на текущем объекте устройства
+# вместо имени может быть функция (dev, value), если одним методом устройства не обойтись
+ACTIONS = {
+    # 'controlname': (transform value from MQTT as arg of dev api method, dev api method name)
+    'power': (bool, set_power),
+    'mode': (OperationMode, 'set_mode'),
+    'target_humidity': (int, 'set_target_humidity'),
+    'speed_level': (int, 'set_speed'),
+    'dry': (bool, 'set_dry'),
+    'buzzer': (bool, 'set_buzzer'),
+    'led_brightness': (LedBrightness, 'set_led_brightness'),
+    'child_lock': (bool, 'set_child_lock'),
+    'clean_mode': (bool, 'set_clean_mode'),
+}
+
 
 @dataclass
 class DeviceParams:
@@ -28,12 +116,6 @@ class ErrorType(Enum):
     write = 'w'
 
 
-@dataclass
-class ErrorState:
-    read: bool = True
-    write: bool = False
-
-
 class ErrorManager:
     """
     Класс хранящий состояние ошибки топика в соотвествии с конвенцией
@@ -43,27 +125,43 @@ class ErrorManager:
     и надо явно помененить что значений нет или они старые
     помечаем ошибкой чтения
     """
-    storage = defaultdict(ErrorState)
+    # состояние топика кодируется битами: 1 - ошибка чтения, 2 - ошибка записи
+    _STATE = (b'', b'r', b'w', b'rw')
+
+    def __init__(self, topics: List[str]):
+        # все топики известны заранее, поэтому храним флаги ошибок в массивах по индексу топика
+        self._index = {t: i for i, t in enumerate(topics)}
+        self._read = bytearray(b'\x01' * len(topics))
+        self._write = bytearray(len(topics))
+        # последнее опубликованное состояние, 0xff - еще не публиковали
+        self._published = bytearray(b'\xff' * len(topics))
 
     def set_error(self, topic: str, error: ErrorType) -> None:
         if error is ErrorType.read:
-            self.storage[topic].read = True
+            self._read[self._index[topic]] = 1
         else:
-            self.storage[topic].write = True
+            self._write[self._index[topic]] = 1
 
     def remove_error(self, topic: str, error: ErrorType) -> None:
         if error is ErrorType.read:
-            self.storage[topic].read = False
+            self._read[self._index[topic]] = 0
         else:
-            self.storage[topic].write = False
+            self._write[self._index[topic]] = 0
+
+    def _code(self, i: int) -> int:
+        return self._read[i] | (self._write[i] << 1)
+
+    def get_state(self, topic: str) -> bytes:
+        return self._STATE[self._code(self._index[topic])]
 
-    def get_state(self, topic: str) -> str:
-        result = ''
-        if self.storage[topic].read:
-            result += 'r'
-        if self.storage[topic].write:
-            result += 'w'
-        return result
+    def is_changed(self, topic: str) -> bool:
+        """Отличается ли состояние топика от последнего опубликованного"""
+        i = self._index[topic]
+        return self._published[i] != self._code(i)
+
+    def mark_published(self, topic: str, state: bytes) -> None:
+        """Запоминаем отправленное состояние, пока шла публикация текущее могло измениться"""
+        self._published[self._index[topic]] = self._STATE.index(state)
 
 
 class TopicManager:
@@ -74,110 +172,86 @@ class TopicManager:
         self.device_name = device_name
         self.mqtt_client = mqtt_client
         self.meta_topics = meta_topics
-        self.err_state = ErrorManager()
+        # meta_topics не меняется за время работы, поэтому имена топиков ручек считаем один раз
+        self._device_topic = f'/devices/{device_name}'
+        self._topic_of = {k: f'{self._device_topic}/controls/{k}' for k in meta_topics if k != 'meta'}
+        self._read_topics = list(self._topic_of.values())
+        # топик команды -> название ручки, чтобы не разбирать топик каждого входящего сообщения
+        # ручки только для чтения сюда не попадают
+        self._topic_to_control = {
+            t + '/on': k for k, t in self._topic_of.items() if not meta_topics[k].get('readonly', False)
+        }
+        self._write_topics = list(self._topic_to_control)
+        self._transform = {k: VALUE_TRANSFORMERS.get(k, to_payload) for k in self._topic_of}
+        self._meta_plan = build_meta_publish_plan(meta_topics, device_name)
+        self.err_state = ErrorManager(self._read_topics)
 
     async def publish_meta(self) -> None:
-        # Публикуем метаинформацию об устройстве из файла в MQTT в соответствии с конвенцией wirenboard MQTT
-        # json файл содержит готовые json для публикации в contols/../meta
-        for k,v in self.meta_topics.items():
-            meta_data = v.copy()
-            if k == 'meta':
-                # Публикация высокоуровневой метинформации об устройстве
-                topic = self.create_topic_name('')
-                # Публикуем английское написание
-                await self.mqtt_client.publish(topic + f'/meta/name', payload=meta_data['title']['en'], retain=True)
-                await self.mqtt_client.publish(topic + f'/meta/driver', payload=meta_data['driver'], retain=True)
-            else:
-                # Публикация метаинформации по конкретным ручкам устройства
-                topic = self.create_topic_name(k)
-                for f in ['type', 'order', 'readonly', 'min', 'max']:
-                    if f == 'readonly':
-                        # true, false превращаем в 0 или 1 для публикации в топик /meta/readonly
-                        # потому что в json который в /meta там должно быть true/false и это более удобно для чтения
-                        value = int(meta_data.get(f, False))
-                    else:
-                        # для остальных значений трансморфмация не требуется
-                        value = meta_data.get(f)
-                    if value is not None:
-                        # если флаг есть в json метафайле, то публикуем его в топик
-                        await self.mqtt_client.publish(topic + f'/meta/{f}', payload=value, retain=True)
-            # публикуем готовый json в топики
-            await self.mqtt_client.publish(topic + '/meta', payload=json.dumps(meta_data), retain=True)
-            # поскольку сначала идет публикация мета инфы, а потом уже идет заполнение полезными значениями
-            # поэтому помечаем ручки ошибкой для чтения
-            await self.mqtt_client.publish(topic + '/meta/error', payload=self.err_state.get_state(topic), retain=True)
+        # Публикуем заранее подготовленную метаинформацию об устройстве в MQTT
+        await asyncio.gather(*(
+            self.mqtt_client.publish(t, payload=p, qos=0, retain=True) for t, p in self._meta_plan
+        ))
+        # поскольку сначала идет публикация мета инфы, а потом уже идет заполнение полезными значениями
+        # поэтому помечаем ручки ошибкой для чтения
+        await asyncio.gather(*(self.publish_error(t) for t in self._read_topics))
 
     async def publish_error_state(self, all_error: ErrorType or None = None) -> None:
         """
         Массовая публикация топиков для чтения ошибкой
         полезно при старте сервиса, его завершение или при ошибке получения информации с устройства
         """
-        for t in self.get_control_read_topics():
-            if all_error is not None:
+        topics = self.get_control_read_topics()
+        if all_error is not None:
+            for t in topics:
                 self.err_state.set_error(t, all_error)
-            await self.mqtt_client.publish(t + '/meta/error', payload=self.err_state.get_state(t), retain=True)
+        await asyncio.gather(*(self.publish_error(t) for t in topics))
+
+    async def publish_error(self, topic: str) -> None:
+        """Публикация текущего состояния ошибки топика в /meta/error"""
+        state = self.err_state.get_state(topic)
+        await self.mqtt_client.publish(topic + '/meta/error', payload=state, qos=0, retain=True)
+        # отмечаем только после успешной отправки, иначе is_changed не даст переопубликовать состояние
+        self.err_state.mark_published(topic, state)
 
     def create_topic_name(self, name: str) -> str:
         if name == '':
-            return f'/devices/{self.device_name}'
-        return f'/devices/{self.device_name}/controls/{name}'
+            return self._device_topic
+        return self._topic_of[name]
 
     async def subscribe_topics(self) -> List[str]:
         topics = self.get_control_write_topics()
         tasks = [self.mqtt_client.subscribe(t) for t in topics]
         res = await asyncio.gather(*tasks)
-        # срезаем /on постфикс
-        return [x[:-3] for x, _ in takewhile(lambda x: x[1][0].is_failure, zip(topics, res))]
+        # возвращаем все топики, подписка на которые не удалась, срезая /on постфикс
+        return [t[:-3] for t, r in zip(topics, res) if r[0].is_failure]
 
     def get_control_write_topics(self) -> List[str]:
-        topics = []
-        for k, v in self.meta_topics.items():
-            if v.get('readonly', False):
-                # пропускаем ручки которые только для чтения
-                continue
-            if k == 'meta':
-                continue
-            else:
-                topics.append(self.create_topic_name(k) + '/on')
-        return topics
+        # ручки только для чтения сюда не попадают
+        return self._write_topics
 
     def get_control_read_topics(self) -> List[str]:
-        topics = []
-        for k, v in self.meta_topics.items():
-            if k == 'meta':
-                continue
-            else:
-                topics.append(self.create_topic_name(k))
-        return topics
+        return self._read_topics
 
     async def publish_status(self, status):
+        pubs = []
         for k, v in status.data.items():
-            v = self.transform_publish_value(k, v)
+            topic = self._topic_of.get(k)
+            if topic is None:
+                # ручки нет в meta_topics, публиковать ее некуда
+                continue
+            v = self._transform[k](v)
 
-            topic = self.create_topic_name(k)
             self.err_state.remove_error(topic, ErrorType.read)
-            await self.mqtt_client.publish(
-                topic + '/meta/error',
-                payload=self.err_state.get_state(topic),
-                retain=True
-            )
-            await self.mqtt_client.publish(topic, payload=v, retain=True)
-
-    def transform_publish_value(self, control_name: str, value: Any) -> Any:
-        if control_name in ['use_time', 'power_time']:
-            value = value // 3600
-        if control_name == 'water_level':
-            value = value // 1.27
-        if control_name in self.meta_topics:
-            if isinstance(value, bool):
-                # в топик надо отправлять 0 или 1 вместо true/false
-                value = int(value)
-        return value
+            # в большинстве опросов состояние ошибки не меняется, поэтому лишний раз его не публикуем
+            if self.err_state.is_changed(topic):
+                pubs.append(self.publish_error(topic))
+            pubs.append(self.mqtt_client.publish(topic, payload=v, qos=0, retain=True))
+        await asyncio.gather(*pubs)
 
     def parse_message(self, message: Message) -> (str, Any):
-        # так как по Wirenboard MQTT топики называются /devices/<devname>/controls/<controlname>/
-        control = message.topic.value.split('/')[-2]
-        data = json.loads(message.payload)
+        # так как по Wirenboard MQTT топики называются /devices/<devname>/controls/<controlname>/on
+        control = self._topic_to_control[message.topic.value]
+        data = orjson.loads(message.payload)
         return control, data
 
 
@@ -185,17 +259,18 @@ class EventCycle:
     """
     Класс, который обеспечивает цикл обработки входящий собыйти или генерирует их сам
     """
-    action_mapping = None
     dev: AirHumidifierMiot = None
-    publish_states_task = None
-    consume_message_task = None
 
     def __init__(self, client: aiomqtt.Client, interval: int, meta_topics: dict, dev_param: DeviceParams):
         self.dev_param = dev_param
         self.interval = interval
         self.client = client
         self.tm = TopicManager(meta_topics, client, dev_param.device_name)
-        self.pending = set()
+        self.inbox = asyncio.Queue()
+        # выставляется, когда надо заново подключиться к устройству
+        self.need_new_dev = asyncio.Event()
+        # python-miio синхронный, запросы к устройству выполняем в отдельном потоке и не более одного за раз
+        self.dev_lock = asyncio.Lock()
 
     async def configure_client(self):
         """
@@ -204,44 +279,21 @@ class EventCycle:
         """
         await self.tm.publish_meta()
         err_topics = await self.tm.subscribe_topics()
-        await self.tm.publish_error_state()  # No errors
-        # если подписка на топики произошла с ошибкой надо соответствующим образом отметить их состояние
+        # отмечаем ошибкой записи только топики, подписка на которые не удалась,
+        # с остальных снимаем ошибку, которая могла остаться от прошлой попытки
+        for t in self.tm.get_control_write_topics():
+            t = t[:-3]
+            if t in err_topics:
+                self.tm.err_state.set_error(t, ErrorType.write)
+            else:
+                self.tm.err_state.remove_error(t, ErrorType.write)
+        await self.tm.publish_error_state()
         if err_topics:
             logging.error('Failed subscribe topics: %s', err_topics)
-            for t in err_topics:
-                self.tm.err_state.remove_error(t, ErrorType.write)
-                await self.client.publish(
-                    t + '/meta/error',
-                    payload=self.tm.err_state.get_state(t),
-                    retain=True
-                )
             raise Exception('subscribe error')
 
-    def create_action_mapping(self):
-        """
-        Таблица трансляции сигналов из mqtt топиков в команды для устройства
-        для каждого топика имеем соответсвующий префикс, функцию трансформации значения из топка и метод, который
-        надо дернуть на устройстве чтобы действие применилось
-        :return:
-        """
-        value_mapping = {
-            # 'controlname': (transform value from MQTT as arg of dev api method)
-            'power': (lambda x: bool(x), lambda x: self.dev.on() if x else self.dev.off()),
-            'mode': (lambda x: OperationMode(x), lambda x: self.dev.set_mode(x)),
-            'target_humidity': (lambda x: x, self.dev.set_target_humidity),
-            'speed_level': (lambda x: x, self.dev.set_speed),
-            'dry': (lambda x: bool(x), self.dev.set_dry),
-            'buzzer': (lambda x: bool(x), self.dev.set_buzzer),
-            'led_brightness': (lambda x: LedBrightness(x), self.dev.set_led_brightness),
-            'child_lock': (lambda x: bool(x), self.dev.set_child_lock),
-            'clean_mode': (lambda x: bool(x), self.dev.set_clean_mode)
-        }
-        return value_mapping
-
     def create_dev(self):
         """Подключение к устройству по протоколу MIot"""
-        if self.publish_states_task is not None:
-            self.publish_states_task.cancel()
         logging.info("Recreate device: %s", self.dev_param.device_name)
         # AirHumidifierMiot
         self.dev = DeviceFactory.create(
@@ -249,7 +301,19 @@ class EventCycle:
             self.dev_param.token,
             model=self.dev_param.type
         )
-        self.action_mapping = self.create_action_mapping()
+
+    async def call_dev(self, func, *args) -> Any:
+        """
+        Вызов синхронного метода python-miio в отдельном потоке, не более одного запроса к устройству за раз
+        """
+        async with self.dev_lock:
+            future = asyncio.ensure_future(asyncio.to_thread(func, *args))
+            try:
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                # поток прервать нельзя, поэтому держим лок пока запрос к устройству не завершится
+                await asyncio.gather(future, return_exceptions=True)
+                raise
 
     async def publish_states(self) -> bool:
         """
@@ -258,107 +322,151 @@ class EventCycle:
         await asyncio.sleep(self.interval)
         need_new_dev = False
         try:
-            last_status = self.dev.status()
+            last_status = await self.call_dev(self.dev.status)
         except Exception as e:
             logging.exception(e)
             need_new_dev = True
-            await self.tm.publish_error_state(ErrorState.read)
+            await self.tm.publish_error_state(ErrorType.read)
         else:
             await self.tm.publish_status(last_status)
         logging.debug("Publish states complete")
         return need_new_dev
 
-    def create_publish_states_task(self):
-        return asyncio.create_task(self.publish_states(), name='publish_states')
-
-    def create_consume_message_task(self):
-        return asyncio.create_task(anext(self.client.messages), name='consume_message')
-
-    async def run(self):
+    async def poll_device(self):
         """
-        Главный цикл работы приложения, раз в interval ждем одно из двух событий: или приходит команда из mqtt
-        или опрашиваем устройство и публикуем его состояние
+        Раз в interval опрашиваем устройство, при необходимости переподключаемся к нему
         """
-        new_dev = True
-        self.consume_message_task = self.create_consume_message_task()
         while True:
             # Если требуется, то переподключаемся к устройству
-            if new_dev:
-                self.create_dev()
-                self.publish_states_task = self.create_publish_states_task()
+            if self.need_new_dev.is_set():
+                self.need_new_dev.clear()
+                async with self.dev_lock:
+                    self.create_dev()
                 # сбрасываем состояние ошибок потому что создаем новое подключение
                 await self.tm.publish_error_state()
+            if await self.publish_states():
+                self.need_new_dev.set()
+
+    async def consume_messages(self):
+        """
+        Разбираем очередь пришедших команд, которую наполняет dispatch_messages
+        """
+        while True:
+            message = await self.inbox.get()
+            await self.handle_message(message)
 
-            # ждем одно из 2 событий в зависимости от того что произойдет раньше
-            done, pending = await asyncio.wait(
-                [self.publish_states_task, self.consume_message_task],
-                return_when=asyncio.FIRST_COMPLETED
-            )
-            # распаковываем нашу функцию из списка
-            done = done.pop()
-            # Определяем какое же это все таки событие
-            if done is self.publish_states_task:
-                new_dev = done.result()
-                self.publish_states_task = self.create_publish_states_task()
+    async def handle_message(self, message: Message):
+        logging.debug('Received message: %s' % message.payload)
+        try:
+            # Распарсили его
+            control, data = self.tm.parse_message(message)
+            logging.debug('Received topic: %s' % control)
+            # Определяем ручку на устройстве согласно сообщения
+            transformer, method = ACTIONS[control]
+        except Exception as e:
+            # кривое сообщение не должно ломать работу устройства, просто пропускаем его
+            logging.exception(e)
+            return
+        topic = self.tm.create_topic_name(control)
+        try:
+            # Дергаем ручку
+            if isinstance(method, str):
+                # берем метод у текущего устройства, DeviceFactory может вернуть наследника со своей реализацией
+                await self.call_dev(getattr(self.dev, method), transformer(data))
             else:
-                # Получили сообщение
-                message = done.result()
-                logging.debug('Received message: %s' % message.payload)
-                # Распарсили его
-                control, data = self.tm.parse_message(message)
-                logging.debug('Received topic: %s' % control)
-                # Определяем ручку на устройстве согласно сообщения
-                transformer, executor = self.action_mapping[control]
-                topic = self.tm.create_topic_name(control)
-                try:
-                    # Дергаем ручку
-                    executor(transformer(data))
-                except Exception as e:
-                    # не смогли дернуть ручку
-                    logging.exception(e)
-                    new_dev = True
-                    self.tm.err_state.set_error(topic, ErrorType.read)
-                else:
-                    # смогли дернуть ручку
-                    self.tm.err_state.remove_error(topic, ErrorType.read)
-                await self.client.publish(
-                    topic + '/meta/error',
-                    payload=self.tm.err_state.get_state(topic),
-                    retain=True
+                await self.call_dev(method, self.dev, transformer(data))
+        except Exception as e:
+            # не смогли дернуть ручку
+            logging.exception(e)
+            self.need_new_dev.set()
+            self.tm.err_state.set_error(topic, ErrorType.read)
+        else:
+            # смогли дернуть ручку
+            self.tm.err_state.remove_error(topic, ErrorType.read)
+        await self.tm.publish_error(topic)
+
+    async def run(self):
+        """
+        Главный цикл работы устройства: опрос устройства и обработка команд из mqtt работают в отдельных задачах
+        """
+        self.need_new_dev.set()
+        # команды, пришедшие пока устройство не работало (сбой или переподключение к mqtt), уже неактуальны
+        while not self.inbox.empty():
+            self.inbox.get_nowait()
+        async with asyncio.TaskGroup() as tg:
+            tg.create_task(self.poll_device(), name='poll_device')
+            tg.create_task(self.consume_messages(), name='consume_messages')
+
+    async def serve(self):
+        """
+        Работа устройства в рамках одного подключения к mqtt
+        ошибки mqtt пробрасываем наверх, по ним переподключаемся,
+        а остальные ошибки устройства не должны останавливать другие устройства, поэтому перезапускаем только его
+        """
+        while True:
+            try:
+                await self.configure_client()
+                await self.run()
+            except aiomqtt.MqttError:
+                raise
+            except Exception as e:
+                mqtt_errors = None
+                if isinstance(e, ExceptionGroup):
+                    # наверх уходят только ошибки mqtt, остальные касаются только этого устройства
+                    mqtt_errors, e = e.split(aiomqtt.MqttError)
+                if e is not None:
+                    logging.error(f"Device {self.dev_param.device_name} failed", exc_info=e)
+                if mqtt_errors is not None:
+                    raise mqtt_errors from None
+                logging.error(
+                    f"Device {self.dev_param.device_name} failed; Restarting in {self.interval} seconds ..."
                 )
-                # заново начинаем ждать сообщение из топиков
-                self.consume_message_task = self.create_consume_message_task()
+                await asyncio.sleep(self.interval)
 
     async def stop(self):
-        self.publish_states_task.cancel()
-        self.consume_message_task.cancel()
-        await self.tm.publish_error_state(ErrorState.read)
+        await self.tm.publish_error_state(ErrorType.read)
+
+
+async def dispatch_messages(client: aiomqtt.Client, dispatch: dict) -> None:
+    """
+    Единственный читатель входящих сообщений mqtt, раскладывает их по очередям устройств
+    """
+    async for message in client.messages:
+        cycle = dispatch.get(message.topic.value)
+        if cycle is None:
+            logging.warning('Unexpected topic: %s', message.topic.value)
+            continue
+        cycle.inbox.put_nowait(message)
 
 
-async def device_thread(mqtt_address: str, meta_topics: dict, dev_param: DeviceParams) -> None:
+async def mqtt_thread(mqtt_address: str, meta_topics: dict, devices: List[DeviceParams]) -> None:
     logging.info('Start service')
-    client = aiomqtt.Client(mqtt_address)
+    # одно подключение к брокеру на все устройства
+    # трафик небольшой, поэтому keepalive редкий
+    client = aiomqtt.Client(mqtt_address, keepalive=120)
     interval = 5  # Seconds
+    # циклы создаем один раз, все что посчитано по meta_topics переживает переподключения к mqtt
+    cycles = [EventCycle(client, interval, meta_topics, d) for d in devices]
+    # топик команды -> устройство, которому она адресована
+    dispatch = {t: c for c in cycles for t in c.tm.get_control_write_topics()}
     while True:
         logging.info('Connect to mqtt')
         async with client:
             try:
-                logging.info('Connect to mqtt -> success')
-                e = EventCycle(client, interval, meta_topics, dev_param)
-                logging.info('Configure mqtt')
-                await e.configure_client()
-                logging.info('Configure mqtt -> success')
-                logging.info('Run event cycle...')
-                await e.run()
+                try:
+                    logging.info('Connect to mqtt -> success')
+                    logging.info('Run event cycles...')
+                    async with asyncio.TaskGroup() as tg:
+                        tg.create_task(dispatch_messages(client, dispatch), name='dispatch_messages')
+                        for c in cycles:
+                            tg.create_task(c.serve(), name=c.dev_param.device_name)
+                except* aiomqtt.MqttError as e:
+                    logging.exception(e)
+                    logging.error(f"Connection lost; Reconnecting in {interval} seconds ...")
+                    await asyncio.sleep(interval)
             except asyncio.CancelledError:
-                await e.stop()
+                await asyncio.gather(*(c.stop() for c in cycles))
                 return
-            except aiomqtt.MqttError as e:
-                logging.exception(e)
-                # for t in pending:
-                #     t.cancel()
-                logging.error(f"Connection lost; Reconnecting in {interval} seconds ...")
-                await asyncio.sleep(interval)
 
 
 with open("configs/meta_topics.json", "r") as f:
@@ -374,12 +482,9 @@ else:
     logging.basicConfig(level=logging.INFO)
 
 async def main():
-    tasks = [asyncio.Task(device_thread(mqtt_address, meta_topics, DeviceParams(**d))) for d in devices]
-    signal.signal(signal.SIGTERM, lambda signum, frame: [t.cancel() for t in tasks])
-    signal.signal(signal.SIGINT, lambda signum, frame: [t.cancel() for t in tasks])
-    task, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
-    # Для корректного завершения работы в случае непредвиденной ошибки
-    task.pop().done()
-    await asyncio.gather(*pending, return_exceptions=True)
-
-asyncio.run(main())
+    task = asyncio.create_task(mqtt_thread(mqtt_address, meta_topics, [DeviceParams(**d) for d in devices]))
+    signal.signal(signal.SIGTERM, lambda signum, frame: task.cancel())
+    signal.signal(signal.SIGINT, lambda signum, frame: task.cancel())
+    await task
+
+asyncio.run(main(), loop_factory=uvloop.new_event_loop)
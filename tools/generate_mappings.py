@@ -36,56 +36,49 @@ iid_mapping = {
 }
 
 
+def build_item(name: str, p: dict) -> dict:
+    """Мета ручки по описанию свойства из спецификации, ключи заполняются только если они нужны"""
+    writable = 'write' in p['access']
+    ranges = p.get('value-range')
+    enums = p.get('value-list')
+    stype = p['format']
+    step = ranges[2] if ranges is not None else 1
+
+    # сначала определяем итоговый тип ручки, от него зависят остальные поля
+    final_type = format_mapping[stype]
+    if ranges is not None and writable:
+        final_type = 'range'
+
+    item = {
+        'title': {
+            'en': name,
+        },
+        "order": 1,
+    }
+    if not writable:
+        item['readonly'] = True
+    unit = unit_mapping[p['unit']] if 'unit' in p else None
+    if unit is not None and enums is None:
+        # у перечислений единиц измерения нет
+        item['units'] = unit
+    if ranges is not None and final_type != 'value':
+        item['min'] = ranges[0]
+        item['max'] = ranges[1]
+    if step > 1 or stype == 'float':
+        item['precision'] = step
+    item['type'] = final_type
+    if enums is not None:
+        item['enum'] = {str(i['value']): {'en': i['description']} for i in enums}
+    return item
+
+
 for s in instance['services']:
     siid = s['iid']
     for p in s['properties']:
-        piid = p['iid']
-        name = iid_mapping.get((siid, piid))
+        name = iid_mapping.get((siid, p['iid']))
         if name is None:
-            # print(p['type'])
             continue
-
-        item = {
-            'title': {
-                'en': name,
-            },
-            "order": 1,
-        }
-        if 'write' not in p['access']:
-            item['readonly'] = True
-        unit = p.get('unit')
-        if unit is not None:
-            if unit_mapping[unit] is not None:
-                item['units'] = unit_mapping[unit]
-
-        ranges = p.get('value-range')
-        step = 1
-        if ranges is not None:
-            step = ranges[2]
-            item['min'] = ranges[0]
-            item['max'] = ranges[1]
-            if step > 1:
-                item['precision'] = step
-
-        stype = p['format']
-        if stype == 'float':
-            item['precision'] = step
-        item['type'] = format_mapping[stype]
-        if ranges is not None and 'write' in p['access']:
-            item['type'] = 'range'
-        if item['type'] == 'value':
-            item.pop('min', None)
-            item.pop('max', None)
-
-        enums = p.get('value-list')
-        if enums is not None:
-            item.pop('units', None)
-            enum_dict = {}
-            for i in enums:
-                enum_dict[str(i['value'])] = {'en': i['description']}
-            item['enum'] = enum_dict
-
-        result[name] = item
+        result[name] = build_item(name, p)
 
 
 extra_patch = {